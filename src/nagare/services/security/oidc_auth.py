@@ -10,10 +10,13 @@
 # --
 
 import os
-import copy
+import re
 import time
+import struct
 import threading
 from base64 import urlsafe_b64decode, urlsafe_b64encode
+from http.cookiejar import DefaultCookiePolicy
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 from jose import JOSEError, jwk, jws, jwt, constants
@@ -22,6 +25,21 @@ from nagare import log, partial
 from nagare.renderers import xml
 from nagare.services.security import cookie_auth
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+SUB_ONLY = frozenset({'sub'})
+# Format version, session id and state id packed in the auth request state
+STATE_IDS = struct.Struct('>Bqq')
+STATE_VERSION = 1
+MAX_AGE_RE = re.compile(r'max-age\s*=\s*(\d+)', re.IGNORECASE)
+
+
+def json_content(response):
+    return response.json() if orjson is None else orjson.loads(response.content)
+
 
 class Login(xml.Renderable):
     ACTION_PRIORITY = 5
@@ -84,7 +102,13 @@ class Authentication(cookie_auth.Authentication):
     }
 
     CONFIG_SPEC = dict(
-        copy.deepcopy(cookie_auth.Authentication.CONFIG_SPEC),
+        cookie_auth.Authentication.CONFIG_SPEC,
+        # Only the ``cookie`` section is modified: no need to deep copy the whole parent specification
+        cookie=dict(
+            cookie_auth.Authentication.CONFIG_SPEC['cookie'],
+            activated='boolean(default=False)',
+            encrypt='boolean(default=False)',
+        ),
         host='string(default="localhost", help="server hostname")',
         port='integer(default=None, help="server port")',
         ssl='boolean(default=True, help="HTTPS protocol")',
@@ -99,11 +123,10 @@ class Authentication(cookie_auth.Authentication):
         ),
         key='string(default=None, help="cookie encoding key")',
         jwks_uri='string(default=None, help="JWK keys set document")',
+        jwks_min_refresh='integer(default=60, help="minimum delay between two JWK keys set fetches, in seconds")',
         issuer='string(default=None, help="server identifier")',
         time_skew='float(default=0, help="Acceptable time skew with the issuer, in seconds")',
     )
-    CONFIG_SPEC['cookie']['activated'] = 'boolean(default=False)'
-    CONFIG_SPEC['cookie']['encrypt'] = 'boolean(default=False)'
     CONFIG_SPEC.update({endpoint: 'string(default=None)' for endpoint in ENDPOINTS})
 
     def __init__(
@@ -122,6 +145,7 @@ class Authentication(cookie_auth.Authentication):
         proxy=None,
         key=None,
         jwks_uri=None,
+        jwks_min_refresh=60,
         issuer=None,
         time_skew=0,
         services_service=None,
@@ -143,6 +167,7 @@ class Authentication(cookie_auth.Authentication):
             proxy=proxy,
             key=key,
             jwks_uri=jwks_uri,
+            jwks_min_refresh=jwks_min_refresh,
             issuer=issuer,
             time_skew=time_skew,
             **config,
@@ -159,12 +184,29 @@ class Authentication(cookie_auth.Authentication):
         self.verify = verify
         self.proxies = {'http': proxy, 'https': proxy} if proxy else None
 
+        # All the communications are with the same server: keep its connections alive
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=32)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # The session is shared by all the users: never store nor replay the cookies received
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=()))
+
         self.issuer = issuer
         self.jwks_uri = jwks_uri
-        self.jwks_expiration = None
+        self.jwks_refresh_enabled = bool(jwks_uri)
+        self.jwks_min_refresh = jwks_min_refresh
+        self.jwks_etag = self.jwks_last_modified = self.jwks_max_age = None
+        self.jwks_expiration = self.jwks_stale_at = None
         self.jwks_lock = threading.Lock()
-        self.signing_keys = {}
+        self.jwks_refresh_in_flight = threading.Event()
+        self.jwks_executor = None
+        self.keys_logger = None
+        self.signing_keys = {}  # kid -> key
+        self.all_signing_keys = []  # Candidates when the token has no or an unknown kid
         self.time_skew = time_skew
+        self.jwt_algorithms = algorithms if secure else None
+        self.jwt_options = {'verify_iss': issuer is not None, 'leeway': time_skew}
 
         self.ident = name
 
@@ -180,9 +222,22 @@ class Authentication(cookie_auth.Authentication):
         )
 
         self.endpoints = {endpoint: (config[endpoint] or '').format(**endpoint_params) for endpoint in self.ENDPOINTS}
+        self.freeze_endpoints()
+
+        # Immutable parts of the requests parameters
+        self.auth_params = {'response_type': 'code', 'client_id': client_id, 'access_type': 'offline'}
+        self.client_payload = {'client_id': client_id, 'client_secret': client_secret}
+        self.token_payload = dict(self.client_payload, grant_type='authorization_code')
+        self.refresh_token_payload = dict(self.client_payload, grant_type='refresh_token')
+
+    def freeze_endpoints(self):
+        self.authorization_endpoint = self.endpoints['authorization_endpoint']
+        self.token_endpoint = self.endpoints['token_endpoint']
+        self.userinfo_endpoint = self.endpoints.get('userinfo_endpoint')
+        self.end_session_endpoint = self.endpoints.get('end_session_endpoint')
 
     def send_request(self, method, url, params=None, data=None):
-        r = requests.request(
+        r = self.session.request(
             method,
             url,
             params=params or {},
@@ -194,98 +249,179 @@ class Authentication(cookie_auth.Authentication):
         r.raise_for_status()
         return r
 
+    def get_document(self, url, headers=None):
+        r = self.session.get(url, headers=headers, verify=self.verify, timeout=self.timeout, proxies=self.proxies)
+        r.raise_for_status()
+        return r
+
     def create_discovery_request(self):
         discovery_endpoint = self.endpoints['discovery_endpoint']
 
         return (None, None, None, None) if discovery_endpoint is None else ('GET', discovery_endpoint, {}, {})
 
     def create_auth_request(self, session_id, state_id, action_id, redirect_url, scopes=(), **params):
-        state = b'%d#%d#%s' % (session_id, state_id, (action_id or '').encode('ascii'))
-
-        params = dict(
-            {
-                'response_type': 'code',
-                'client_id': self.client_id,
-                'redirect_uri': redirect_url,
-                'scope': ' '.join({'openid'} | set(scopes)),
-                'access_type': 'offline',
-                'state': '#{}#{}'.format(self.ident, self.encrypt(state).decode('ascii')),
-            },
+        state = STATE_IDS.pack(STATE_VERSION, session_id or 0, state_id or 0) + (action_id or '').encode('ascii')
+        scope = ' '.join(['openid'] + sorted({scope for scope in scopes if scope != 'openid'})) if scopes else 'openid'
+
+        params = {
+            **self.auth_params,
+            'redirect_uri': redirect_url,
+            'scope': scope,
+            'state': f'#{self.ident}#{self.encrypt(state).decode("ascii")}',
             **params,
-        )
+        }
 
-        return 'GET', self.endpoints['authorization_endpoint'], params, {}
+        return 'GET', self.authorization_endpoint, params, {}
 
     def create_token_request(self, redirect_url, code):
-        payload = {
-            'grant_type': 'authorization_code',
-            'code': code,
-            'redirect_uri': redirect_url,
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-        }
+        payload = {**self.token_payload, 'code': code, 'redirect_uri': redirect_url}
 
-        return 'POST', self.endpoints['token_endpoint'], {}, payload
+        return 'POST', self.token_endpoint, {}, payload
 
     def create_refresh_token_request(self, refresh_token):
-        payload = {
-            'grant_type': 'refresh_token',
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'refresh_token': refresh_token,
-        }
+        payload = {**self.refresh_token_payload, 'refresh_token': refresh_token}
 
-        return 'POST', self.endpoints['token_endpoint'], {}, payload
+        return 'POST', self.token_endpoint, {}, payload
 
     def create_end_session_request(self, refresh_token):
-        payload = {'client_id': self.client_id, 'client_secret': self.client_secret, 'refresh_token': refresh_token}
+        payload = {**self.client_payload, 'refresh_token': refresh_token}
 
-        return 'POST', self.endpoints['end_session_endpoint'], {}, payload
+        return 'POST', self.end_session_endpoint, {}, payload
 
     def create_userinfo_request(self, access_token):
-        return 'POST', self.endpoints.get('userinfo_endpoint'), {}, {'access_token': access_token}
+        return 'POST', self.userinfo_endpoint, {}, {'access_token': access_token}
 
-    def fetch_keys(self):
-        if self.jwks_uri and self.jwks_expiration and (time.time() > self.jwks_expiration):
+    @staticmethod
+    def construct_key(key):
+        """Build the JOSE key object once, instead of on each token verification.
+
+        Only possible when the algorithm is declared: else the raw JWK is kept and the key object
+        will be built with the algorithm of each token
+        """
+        algorithm = key.get('alg')
+        if not algorithm:
+            return key
+
+        try:
+            return jwk.construct(key, algorithm)
+        except JOSEError:
+            return key
+
+    def refresh_keys(self):
+        logger = self.keys_logger
+
+        headers = {}
+        if self.jwks_etag:
+            headers['If-None-Match'] = self.jwks_etag
+        if self.jwks_last_modified:
+            headers['If-Modified-Since'] = self.jwks_last_modified
+
+        certs = self.get_document(self.jwks_uri, headers)
+
+        if certs.status_code == 304:
+            logger.debug('Signing keys not modified: {}'.format(sorted(self.signing_keys)))
+        else:
+            signing_keys = self.signing_keys
+            new_keys = {key.pop('kid', None): key for key in json_content(certs).get('keys', [])}
+            if new_keys.keys() != signing_keys.keys():
+                logger.debug('New signing keys fetched: {} -> {}'.format(sorted(signing_keys), sorted(new_keys)))
+                # Build the new keys set apart then swap it in one assignment so readers never see a partial set
+                new_signing_keys = {kid: self.construct_key(key) for kid, key in new_keys.items()}
+                self.all_signing_keys = list(new_signing_keys.values())
+                self.signing_keys = new_signing_keys
+            else:
+                logger.debug('Same signing keys fetched: {}'.format(sorted(signing_keys)))
+
+            # Validators only stored once the keys are successfully loaded
+            self.jwks_etag = certs.headers.get('ETag')
+            self.jwks_last_modified = certs.headers.get('Last-Modified')
+
+        max_age = MAX_AGE_RE.search(certs.headers.get('Cache-Control', ''))
+        if max_age:
+            self.jwks_max_age = max_age = int(max_age.group(1))
+        elif certs.status_code == 304:
+            # A 304 often doesn't repeat the ``Cache-Control`` header: keep the last known max age
+            max_age = self.jwks_max_age
+        else:
+            self.jwks_max_age = None
+
+        if max_age is not None:
+            max_age = max(max_age, self.jwks_min_refresh)
+            logger.debug('Signing keys max age: {}'.format(max_age))
+            now = time.monotonic()
+            self.jwks_stale_at = now + max_age * 0.8
+            self.jwks_expiration = now + max_age
+        else:
+            logger.debug('No expiration date for signing keys')
+            self.jwks_stale_at = self.jwks_expiration = None
+
+    def refresh_keys_ahead(self):
+        try:
             with self.jwks_lock:
-                logger = log.get_logger('.keys', self.logger)
-                certs = self.send_request('GET', self.jwks_uri)
-
-                new_keys = certs.json().get('keys', [])
-                new_keys_id = {key['kid'] for key in new_keys}
-                if new_keys_id != set(self.signing_keys):
-                    logger.debug(
-                        'New signing keys fetched: {} -> {}'.format(sorted(self.signing_keys), sorted(new_keys_id))
-                    )
-                    self.signing_keys = {key.pop('kid', None): key for key in new_keys}
-                else:
-                    logger.debug('Same signing keys fetched: {}'.format(sorted(self.signing_keys)))
-
-                cache_controls = [v.split('=') for v in certs.headers['Cache-Control'].split(',') if '=' in v]
-                cache_controls = {k.strip(): v.strip() for k, v in cache_controls}
-                max_age = cache_controls.get('max-age')
-
-                if max_age and max_age.isdigit():
-                    logger.debug('Signing keys max age: {}'.format(max_age))
-                    self.jwks_expiration = time.time() + int(max_age)
-                else:
-                    logger.debug('No expiration date for signing keys')
-                    self.jwks_expiration = None
+                stale_at = self.jwks_stale_at
+                if (stale_at is not None) and (time.monotonic() > stale_at):
+                    try:
+                        self.refresh_keys()
+                    except Exception:
+                        self.keys_logger.exception('Background refresh of the signing keys failed')
+
+                        # Don't retry on the next request but after a delay
+                        expiration = self.jwks_expiration
+                        if expiration is not None:
+                            self.jwks_stale_at = min(time.monotonic() + self.jwks_min_refresh, expiration)
+        finally:
+            self.jwks_refresh_in_flight.clear()
+
+    def fetch_keys(self):
+        if not self.jwks_refresh_enabled:
+            return
+
+        # Monotonic clock: immune to the wall clock adjustments
+        stale_at, expiration = self.jwks_stale_at, self.jwks_expiration
+        if (stale_at is None) or (time.monotonic() <= stale_at):
+            return
+
+        executor = self.jwks_executor  # Read once: can be concurrently shut down by ``handle_stop()``
+        if (executor is not None) and (expiration is not None) and (time.monotonic() <= expiration):
+            # Keys still valid but soon expired: refresh them in background while serving the cached ones
+            if not self.jwks_refresh_in_flight.is_set():
+                with self.jwks_lock:
+                    if not self.jwks_refresh_in_flight.is_set():
+                        self.jwks_refresh_in_flight.set()
+                        try:
+                            executor.submit(self.refresh_keys_ahead)
+                        except RuntimeError:
+                            # Executor shut down
+                            self.jwks_refresh_in_flight.clear()
+            return
+
+        with self.jwks_lock:
+            # Double check: another thread may have refreshed the keys while we were waiting for the lock
+            expiration = self.jwks_expiration
+            if (expiration is not None) and (time.monotonic() > expiration):
+                self.refresh_keys()
 
     def handle_start(self, app, oidc_listener_service):
         oidc_listener_service.register_service(self.ident, self)
 
         method, url, params, data = self.create_discovery_request()
         if url:
-            r = self.send_request(method, url, params, data).json()
+            r = json_content(self.send_request(method, url, params, data))
 
             self.issuer = r['issuer']
+            self.jwt_options['verify_iss'] = True
             self.endpoints = {endpoint: r.get(endpoint) for endpoint in self.ENDPOINTS}
             jwks_uri = r.get('jwks_uri')
             if jwks_uri and not self.jwks_uri:
                 self.jwks_uri = jwks_uri
 
-        self.jwks_expiration = time.time() - 1
+        # The endpoints are now frozen
+        self.freeze_endpoints()
+
+        self.keys_logger = log.get_logger('.keys', self.logger)
+        self.jwks_refresh_enabled = bool(self.jwks_uri)
+        self.jwks_stale_at = self.jwks_expiration = time.monotonic() - 1
+        self.jwks_executor = ThreadPoolExecutor(max_workers=1)
 
         missing_endpoints = [endpoint for endpoint in self.REQUIRED_ENDPOINTS if not self.endpoints[endpoint]]
         if missing_endpoints:
@@ -293,6 +429,13 @@ class Authentication(cookie_auth.Authentication):
 
         self.fetch_keys()
 
+    def handle_stop(self, app):
+        if self.jwks_executor is not None:
+            self.jwks_executor.shutdown(wait=False)
+            self.jwks_executor = None
+
+        self.session.close()
+
     def handle_request(self, chain, **params):
         self.fetch_keys()
         return super(Authentication, self).handle_request(chain, **params)
@@ -302,23 +445,31 @@ class Authentication(cookie_auth.Authentication):
         return self.send_request(method, url, params, data)
 
     def is_auth_response(self, request):
-        code, session_id, state_id, action_id = None, 0, 0, ''
-
-        state = request.params.get('state', '')
         code = request.params.get('code')
+        if not code:
+            # Not an authentication response: the case of nearly all the requests
+            return None, 0, 0, ''
+
+        session_id, state_id, action_id = 0, 0, ''
 
-        if code and state.startswith('#'):
-            state = state.rsplit('#', 1)[1]
+        state = request.params.get('state', '')
+        if state.startswith('#'):
             try:
-                state = self.decrypt(state.encode('ascii')).decode('ascii')
-                session_id, state_id, action_id = state.split('#')
-            except cookie_auth.InvalidToken:
+                state = self.decrypt(state[state.rfind('#') + 1 :].encode('ascii'))
+                version, session_id, state_id = STATE_IDS.unpack_from(state)
+                action_id = state[STATE_IDS.size :].decode('ascii')
+            except (cookie_auth.InvalidToken, struct.error, UnicodeDecodeError):
+                version = None
+
+            if version != STATE_VERSION:
+                # Invalid, truncated or previous format state
+                session_id, state_id, action_id = 0, 0, ''
                 code = None
 
-        return code, int(session_id), int(state_id), action_id
+        return code, session_id, state_id, action_id
 
     def to_cookie(self, **credentials):
-        credentials = self.filter_credentials(credentials, {'sub'})
+        credentials = self.filter_credentials(credentials, SUB_ONLY)
 
         if self.encrypted:
             cookie = super(Authentication, self).to_cookie(credentials.pop('sub'), **credentials)
@@ -333,7 +484,7 @@ class Authentication(cookie_auth.Authentication):
             credentials['sub'] = principal
         else:
             credentials = jwt.decode(cookie.decode('ascii'), self.jwk_key, 'HS256')
-            credentials = self.filter_credentials(credentials, {'sub'})
+            credentials = self.filter_credentials(credentials, SUB_ONLY)
 
         return credentials['sub'], credentials
 
@@ -346,11 +497,32 @@ class Authentication(cookie_auth.Authentication):
 
     @staticmethod
     def filter_credentials(credentials, to_keep):
-        return {k: v for k, v in credentials.items() if k in to_keep}
+        return {k: credentials[k] for k in to_keep if k in credentials}
 
     def store_credentials(self, session, credentials):
         if not self.cookie and session:
-            session['nagare.credentials'] = self.filter_credentials(credentials, {'sub'})
+            session['nagare.credentials'] = self.filter_credentials(credentials, SUB_ONLY)
+
+    def decode_id_token(self, id_token, access_token=None):
+        headers = jws.get_unverified_header(id_token)
+        kid = headers.get('kid')
+
+        key = self.signing_keys.get(kid) if kid else None
+        if key is None:
+            key = self.all_signing_keys
+
+        options = self.jwt_options.copy()
+        options['verify_at_hash'] = access_token is not None
+
+        return jwt.decode(
+            id_token,
+            key,
+            self.jwt_algorithms,
+            options,
+            audience=self.client_id,
+            issuer=self.issuer,
+            access_token=access_token,
+        )
 
     def request_credentials(self, request, code, action_id):
         credentials = {}
@@ -360,7 +532,7 @@ class Authentication(cookie_auth.Authentication):
         if response.status_code == 400:
             error = response.text
             if response.headers.get('content-type') == 'application/json':
-                response = response.json()
+                response = json_content(response)
                 if 'error' in response:
                     error = response['error']
                     description = response.get('error_description')
@@ -370,28 +542,13 @@ class Authentication(cookie_auth.Authentication):
         elif response.status_code != 200:
             self.logger.error('Authentication error')
         else:
-            tokens = response.json()
+            tokens = json_content(response)
             id_token = tokens['id_token']
 
             try:
-                headers = jws.get_unverified_header(id_token)
-                key = self.signing_keys.get(headers.get('kid'), self.signing_keys)
-
-                credentials = jwt.decode(
-                    id_token,
-                    key,
-                    self.algorithms if self.secure else None,
-                    {
-                        'verify_iss': self.issuer is not None,
-                        'verify_at_hash': 'access_token' in tokens,
-                        'leeway': self.time_skew,
-                    },
-                    audience=self.client_id,
-                    issuer=self.issuer,
-                    access_token=tokens.get('access_token'),
-                )
+                credentials = self.decode_id_token(id_token, tokens.get('access_token'))
             except JOSEError as e:
-                self.logger.error('Invalid id_token: ' + e.args[0])
+                self.logger.error('Invalid id_token: ' + str(e))
             else:
                 credentials['access_token'] = tokens['access_token']
                 refresh_token = tokens.get('refresh_token')
@@ -453,7 +610,7 @@ class Authentication(cookie_auth.Authentication):
             return {}
 
         response = self.send_request(method, url, params, data)
-        return response.json() if response.status_code == 200 else {}
+        return json_content(response) if response.status_code == 200 else {}
 
 
 class AuthenticationWithDiscovery(Authentication):
@@ -0,0 +1,93 @@
+# Encoding: utf-8
+
+# --
+# Copyright (c) 2008-2024 Net-ng.
+# All rights reserved.
+#
+# This software is licensed under the BSD License, as described in
+# the file LICENSE.txt, which you should have received as part of
+# this distribution.
+# --
+
+import binascii
+from types import SimpleNamespace
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from nagare.services.security import oidc_auth, cookie_auth
+
+
+class Authentication(oidc_auth.Authentication):
+    """Only the state encoding / decoding, with a reversible but not encrypted cipher."""
+
+    def __init__(self):
+        self.ident = 'oidc'
+        self.auth_params = {}
+        self.authorization_endpoint = 'https://idp/auth'
+
+    @staticmethod
+    def encrypt(data):
+        return urlsafe_b64encode(data)
+
+    @staticmethod
+    def decrypt(data):
+        try:
+            return urlsafe_b64decode(data)
+        except binascii.Error:
+            raise cookie_auth.InvalidToken() from None
+
+
+def create_state(session_id, state_id, action_id):
+    _, _, params, _ = Authentication().create_auth_request(session_id, state_id, action_id, 'https://app/')
+    return params['state']
+
+
+def auth_response(**params):
+    return Authentication().is_auth_response(SimpleNamespace(params=params))
+
+
+def test_state_round_trip():
+    state = create_state(1234567890123456, 42, 'a.b_c')
+    assert state.startswith('#oidc#')
+    assert auth_response(code='xyz', state=state) == ('xyz', 1234567890123456, 42, 'a.b_c')
+
+
+def test_state_without_action():
+    assert auth_response(code='xyz', state=create_state(1, 2, None)) == ('xyz', 1, 2, '')
+
+
+def test_state_none_and_negative_ids():
+    assert auth_response(code='xyz', state=create_state(None, None, 'a')) == ('xyz', 0, 0, 'a')
+    assert auth_response(code='xyz', state=create_state(-5, -1, 'a')) == ('xyz', -5, -1, 'a')
+
+
+def test_no_code():
+    assert auth_response() == (None, 0, 0, '')
+    assert auth_response(state=create_state(1, 2, 'a')) == (None, 0, 0, '')
+
+
+def test_not_an_encrypted_state():
+    assert auth_response(code='xyz', state='foo') == ('xyz', 0, 0, '')
+
+
+def test_invalid_token():
+    assert auth_response(code='xyz', state='#oidc#a') == (None, 0, 0, '')
+
+
+def encrypted_state(state):
+    return '#oidc#' + Authentication.encrypt(state).decode('ascii')
+
+
+def test_truncated_state():
+    state = oidc_auth.STATE_IDS.pack(oidc_auth.STATE_VERSION, 1, 2)
+    assert auth_response(code='xyz', state=encrypted_state(state[:-1])) == (None, 0, 0, '')
+    assert auth_response(code='xyz', state=encrypted_state(b'')) == (None, 0, 0, '')
+
+
+def test_non_ascii_action():
+    state = oidc_auth.STATE_IDS.pack(oidc_auth.STATE_VERSION, 1, 2) + b'\xff'
+    assert auth_response(code='xyz', state=encrypted_state(state)) == (None, 0, 0, '')
+
+
+def test_previous_format_state():
+    assert auth_response(code='xyz', state=encrypted_state(b'1#2#a')) == (None, 0, 0, '')
+    assert auth_response(code='xyz', state=encrypted_state(b'1234567890123456#2#a')) == (None, 0, 0, '')